@@ -3,19 +3,55 @@
 # It's designed to be run as a separate microservice.
 
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
 import torch
-from transformers import BertTokenizer, BertForSequenceClassification
+from transformers import BertTokenizerFast, BertForSequenceClassification
 import numpy as np
+import functools
 import json
 import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
 from dotenv import load_dotenv
 
+# ONNX Runtime is optional. If it's installed we serve the model through it,
+# otherwise we simply fall back to running the PyTorch model directly.
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# Same idea for TensorRT, which is only ever installed on GPU hosts.
+try:
+    import tensorrt as trt
+except ImportError:
+    trt = None
+
 # Load environment variables from a .env file if it exists.
 load_dotenv()
 
 # --- App Initialization ---
+# Makes Flask use orjson for request.get_json() and jsonify(). It's several times faster
+# than the standard library's json module, which adds up on a latency-sensitive endpoint.
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson already produces bytes, so build the response from those directly.
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app) # Enable Cross-Origin Resource Sharing for all routes.
 
 # --- Model & Globals ---
@@ -25,51 +61,548 @@ model = None
 tokenizer = None
 config = None
 label_encoder_classes = None
+# The ONNX Runtime session, if we managed to build one at startup.
+ort_session = None
+# The TensorRT engine wrapper, if we're on a GPU with TensorRT installed.
+trt_runner = None
+# A captured CUDA graph for single-text requests when serving from PyTorch on a GPU.
+cuda_graph_runner = None
+# The torch.compile'd model, when serving from PyTorch on a GPU with TORCH_COMPILE on.
+compiled_runner = None
+# Which of the above ended up serving requests ('tensorrt', 'onnx' or 'torch').
+backend = None
 # Automatically detect if a GPU is available, otherwise fall back to CPU.
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# Which inference engine to use: 'auto' (TensorRT, then ONNX Runtime, then PyTorch,
+# depending on what's available), 'tensorrt', 'onnx' or 'torch'.
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'auto').lower()
+# The fine-tuned weights. Anything we derive from them is rebuilt when this file changes.
+MODEL_WEIGHTS_PATH = 'model/best_model/model.safetensors'
+# Where the exported ONNX graph is cached between runs.
+ONNX_MODEL_PATH = 'model/best_model.onnx'
+# Where the compiled TensorRT engine is cached. Ideally this gets built once when
+# the container image is built, since compiling it takes a few minutes.
+TRT_ENGINE_PATH = 'model/bert.plan'
+# The largest batch the TensorRT engine is built for.
+TRT_MAX_BATCH = 32
+# Set TORCH_COMPILE=true to run the PyTorch backend through torch.compile on GPU hosts.
+TORCH_COMPILE = os.getenv('TORCH_COMPILE', 'false').lower() == 'true'
+
+# Concurrent /analyze requests are grouped into a single forward pass. A batch is sent
+# off as soon as it has BATCH_MAX texts or BATCH_TIMEOUT_MS has passed since the first
+# one arrived. Set BATCH_MAX to 1 to run every request on its own.
+BATCH_MAX = int(os.getenv('BATCH_MAX', 16))
+BATCH_TIMEOUT_MS = float(os.getenv('BATCH_TIMEOUT_MS', 10))
+# Texts longer than this (in characters) are tokenized on every request instead of being cached.
+CACHE_MAX_TEXT_LENGTH = 2000
+# Pending requests, as (input_ids, attention_mask, event to signal when done, dict to put the result in).
+request_queue = queue.Queue()
+# Whether requests go through the batching thread. Set by start_batch_worker().
+batching_enabled = False
+
+
+# --- TensorRT Runner ---
+
+# Wraps a deserialized TensorRT engine so it can be called just like the other backends.
+# All buffers are allocated once up front (sized for the largest batch the engine accepts)
+# and every call just uses a slice of them.
+class TRTRunner:
+    def __init__(self, engine_path, max_batch, max_length, num_labels):
+        logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, 'rb') as f:
+            self.engine = trt.Runtime(logger).deserialize_cuda_engine(f.read())
+        if self.engine is None:
+            raise RuntimeError(f"Failed to deserialize TensorRT engine from '{engine_path}'.")
+        self.context = self.engine.create_execution_context()
+        self.stream = torch.cuda.Stream()
+        # An execution context can only run one inference at a time.
+        self.lock = threading.Lock()
+        self.num_labels = num_labels
+
+        # The ONNX parser may turn our int64 inputs into int32, so ask the engine what it expects.
+        dtypes = {trt.int32: torch.int32, trt.int64: torch.int64, trt.float32: torch.float32, trt.float16: torch.float16}
+        sizes = {
+            'input_ids': max_batch * max_length,
+            'attention_mask': max_batch * max_length,
+            'logits': max_batch * num_labels
+        }
+        # Pinned host buffers make the host <-> device copies asynchronous.
+        self.host_buffers = {}
+        self.device_buffers = {}
+        for name, size in sizes.items():
+            dtype = dtypes[self.engine.get_tensor_dtype(name)]
+            self.host_buffers[name] = torch.empty(size, dtype=dtype, pin_memory=True)
+            self.device_buffers[name] = torch.empty(size, dtype=dtype, device='cuda')
+
+    def __call__(self, input_ids, attention_mask):
+        batch_size, seq_length = input_ids.shape
+        with self.lock, torch.cuda.stream(self.stream):
+            for name, tensor in (('input_ids', input_ids), ('attention_mask', attention_mask)):
+                host = self.host_buffers[name][:batch_size * seq_length].view(batch_size, seq_length)
+                host.copy_(tensor)
+                device_buffer = self.device_buffers[name][:batch_size * seq_length].view(batch_size, seq_length)
+                device_buffer.copy_(host, non_blocking=True)
+                self.context.set_input_shape(name, (batch_size, seq_length))
+                self.context.set_tensor_address(name, device_buffer.data_ptr())
+
+            device_logits = self.device_buffers['logits'][:batch_size * self.num_labels]
+            self.context.set_tensor_address('logits', device_logits.data_ptr())
+            self.context.execute_async_v3(self.stream.cuda_stream)
+
+            host_logits = self.host_buffers['logits'][:batch_size * self.num_labels]
+            host_logits.copy_(device_logits, non_blocking=True)
+            self.stream.synchronize()
+            # Copy out of the pinned buffer, since the next call will overwrite it.
+            return host_logits.view(batch_size, self.num_labels).float().numpy().copy()
+
+
+# --- CUDA Graph Runners ---
+
+# Fixed-size GPU input buffers for the CUDA graph runners below. A graph only works for the
+# exact shapes it was captured with, so inputs are copied into these buffers, with the unused
+# rows and tail left as padding.
+class StaticInputBuffers:
+    def __init__(self, batch_size, max_length):
+        self.input_ids = torch.zeros((batch_size, max_length), dtype=torch.long, device='cuda')
+        self.attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long, device='cuda')
+
+    def fill(self, input_ids, attention_mask):
+        batch_size, seq_length = input_ids.shape
+        # Zero ids and a zero mask are exactly what padding='max_length' would have produced.
+        self.input_ids.zero_()
+        self.attention_mask.zero_()
+        self.input_ids[:batch_size, :seq_length].copy_(input_ids)
+        self.attention_mask[:batch_size, :seq_length].copy_(attention_mask)
+
+
+# Captures a single-text forward pass as a CUDA graph and replays it for each request.
+# At batch size 1 most of the GPU time is spent launching BERT's many small kernels;
+# replaying a graph launches all of them in one go.
+class CUDAGraphRunner:
+    def __init__(self, model, max_length):
+        self.inputs = StaticInputBuffers(1, max_length)
+        # Replaying overwrites the same buffers, so only one request can use the graph at a time.
+        self.lock = threading.Lock()
+
+        # CUDA needs a few warm-up runs on a side stream before a graph can be captured.
+        warmup_stream = torch.cuda.Stream()
+        warmup_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(warmup_stream), torch.inference_mode():
+            for _ in range(3):
+                model(self.inputs.input_ids, self.inputs.attention_mask)
+        torch.cuda.current_stream().wait_stream(warmup_stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.inference_mode(), torch.cuda.graph(self.graph):
+            self.static_logits = model(self.inputs.input_ids, self.inputs.attention_mask)['logits']
+
+    def __call__(self, input_ids, attention_mask):
+        with self.lock:
+            self.inputs.fill(input_ids, attention_mask)
+            self.graph.replay()
+            return self.static_logits.cpu().numpy()
+
+
+# Runs the model through torch.compile in 'reduce-overhead' mode, which generates fused kernels
+# and replays them as CUDA graphs, so it replaces both TorchScript and our own CUDAGraphRunner.
+# A CUDA graph is recorded for every new input shape, so the model is compiled for fixed shapes
+# only (dynamic=False): single texts run at (1, max_length), and any bigger batch is padded up
+# to (max_batch, max_length). The recorded graphs belong to the thread that recorded them, so
+# warm_up() and every call must come from the same thread, which is the batching thread.
+class CompiledModelRunner:
+    def __init__(self, model, max_batch, max_length):
+        self.model = torch.compile(model, mode='reduce-overhead', dynamic=False)
+        self.single_inputs = StaticInputBuffers(1, max_length)
+        self.batch_inputs = StaticInputBuffers(max_batch, max_length) if max_batch > 1 else None
+
+    # Compiling and recording the graphs happen on the first calls, so get them out of the way
+    # before the first real request.
+    def warm_up(self):
+        with torch.inference_mode():
+            for inputs in (self.single_inputs, self.batch_inputs):
+                if inputs is None:
+                    continue
+                for _ in range(3):
+                    self.model(inputs.input_ids, inputs.attention_mask)
+
+    def __call__(self, input_ids, attention_mask):
+        batch_size = input_ids.shape[0]
+        inputs = self.single_inputs if batch_size == 1 else self.batch_inputs
+        inputs.fill(input_ids, attention_mask)
+        with torch.inference_mode():
+            logits = self.model(inputs.input_ids, inputs.attention_mask)['logits']
+        # The rows past batch_size are just padding.
+        return logits[:batch_size].cpu().numpy()
+
 
 # --- Helper Functions ---
 
 # This function handles loading the saved BERT model, tokenizer,
 # and all the necessary configuration files from the 'model/' directory.
-def load_model_and_config():
-    global model, tokenizer, config, label_encoder_classes
+# intra_op_threads caps how many threads ONNX Runtime/PyTorch use for a single forward
+# pass. By default both use every core, which is what we want unless several processes
+# (e.g. Gunicorn workers) are sharing the machine.
+def load_model_and_config(intra_op_threads=None):
+    global model, ort_session, trt_runner, cuda_graph_runner, compiled_runner, backend
     try:
         print("Attempting to load model and configuration...")
-        with open('model/model_config.json', 'r') as f:
-            config = json.load(f)
-        
-        # Load the fine-tuned model and tokenizer from the 'best_model' directory.
-        model = BertForSequenceClassification.from_pretrained('model/best_model')
-        tokenizer = BertTokenizer.from_pretrained('model/best_model')
-        
-        # Move the model to the selected device (GPU or CPU).
-        model.to(device)
-        # Set the model to evaluation mode (disables dropout, etc.).
-        model.eval()
-        
-        # Load the class labels (e.g., 'happy', 'sad', 'suicidal').
-        label_encoder_classes = np.load('model/label_encoder_classes.npy', allow_pickle=True).tolist()
-        
-        print(f"Model and tokenizer loaded successfully. Running on {device}.")
+        load_config_and_tokenizer()
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+
+        # TensorRT is the fastest option, but it needs both a GPU and the tensorrt package.
+        if INFERENCE_BACKEND in ('auto', 'tensorrt') and trt is not None and device.type == 'cuda':
+            try:
+                build_trt_engine()
+                trt_runner = TRTRunner(TRT_ENGINE_PATH, TRT_MAX_BATCH, config['max_length'], len(label_encoder_classes))
+                backend = 'tensorrt'
+            except Exception as e:
+                print(f"Could not set up TensorRT, trying the next backend: {str(e)}")
+                trt_runner = None
+        elif INFERENCE_BACKEND == 'tensorrt':
+            print("INFERENCE_BACKEND is 'tensorrt' but TensorRT or a GPU isn't available, trying the next backend.")
+
+        # Next up is ONNX Runtime.
+        if backend is None and INFERENCE_BACKEND in ('auto', 'onnx', 'tensorrt') and ort is not None:
+            try:
+                ort_session = load_ort_session(intra_op_threads)
+                backend = 'onnx'
+            except Exception as e:
+                print(f"Could not set up ONNX Runtime, falling back to PyTorch: {str(e)}")
+                ort_session = None
+        elif INFERENCE_BACKEND == 'onnx':
+            print("INFERENCE_BACKEND is 'onnx' but onnxruntime isn't installed, falling back to PyTorch.")
+
+        # Neither of the faster runtimes is in use, so serve straight from PyTorch. Its SDPA
+        # attention runs Q/K/V, softmax and the weighted sum as one fused kernel.
+        if backend is None:
+            model = prepare_torch_model(load_torch_model(attn_implementation='sdpa'))
+            backend = 'torch'
+            if device.type == 'cuda' and TORCH_COMPILE:
+                # Compiling happens later, on the batching thread (see start_batch_worker()).
+                compiled_runner = CompiledModelRunner(model, max(BATCH_MAX, 1), config['max_length'])
+            elif device.type == 'cuda':
+                try:
+                    cuda_graph_runner = CUDAGraphRunner(model, config['max_length'])
+                    print("Captured a CUDA graph for single-text requests.")
+                except Exception as e:
+                    print(f"Could not capture a CUDA graph, running single requests normally: {str(e)}")
+                    cuda_graph_runner = None
+
+        print(f"Model and tokenizer loaded successfully. Running on {device} with the '{backend}' backend.")
         return True
     except Exception as e:
         print(f"Error loading model: {str(e)}")
         print("   Please ensure the 'model/' directory contains all necessary files.")
         return False
 
+# Loads the model config, the tokenizer and the class labels, which every backend needs.
+def load_config_and_tokenizer():
+    global tokenizer, config, label_encoder_classes
+    with open('model/model_config.json', 'r') as f:
+        config = json.load(f)
+    
+    # Load the tokenizer from the 'best_model' directory. The 'fast' tokenizer is the Rust
+    # implementation, which is several times quicker than the pure-Python BertTokenizer.
+    tokenizer = BertTokenizerFast.from_pretrained('model/best_model')
+    # The first call switches on truncation, which changes the tokenizer's settings. Do it
+    # now, before any request threads share it (see tokenize_text()).
+    tokenize_text('warm up')
+    # Anything cached from a previous tokenizer is no longer valid.
+    cached_tokenize_text.cache_clear()
+    
+    # Load the class labels (e.g., 'happy', 'sad', 'suicidal').
+    label_encoder_classes = np.load('model/label_encoder_classes.npy', allow_pickle=True).tolist()
+
+# Builds the cached ONNX graph / TensorRT engine ahead of time. Under Gunicorn this runs once
+# in the master process, so the workers don't all race each other to write the same files.
+# If it fails, load_model_and_config() will just try again (and fall back) in each worker.
+def prepare_model_artifacts():
+    try:
+        load_config_and_tokenizer()
+        use_trt = INFERENCE_BACKEND in ('auto', 'tensorrt') and trt is not None and device.type == 'cuda'
+        use_ort = INFERENCE_BACKEND in ('auto', 'onnx', 'tensorrt') and ort is not None
+        # The TensorRT engine is built from the ONNX export, and ONNX Runtime is the fallback
+        # if TensorRT can't be set up, so export first even if the engine build then fails.
+        if use_trt or use_ort:
+            export_onnx_model()
+        if use_trt:
+            build_trt_engine()
+    except Exception as e:
+        print(f"Could not prepare model files ahead of time: {str(e)}")
+
+# Loads the fine-tuned PyTorch model from the 'best_model' directory, ready for inference.
+# The weights are stored as safetensors, which are memory-mapped straight from disk, and
+# low_cpu_mem_usage makes the model's parameters use that mapping instead of copying it
+# into freshly allocated memory. On CPU, the torch backend only replaces the Linear layers
+# with INT8 copies, so the FP32 tensors it keeps (embeddings, LayerNorm) stay backed by the
+# same file in every Gunicorn worker and the OS holds just one copy of them in RAM. The
+# INT8 weights are still per worker, as is everything on the ONNX Runtime and GPU backends.
+def load_torch_model(attn_implementation):
+    torch_model = BertForSequenceClassification.from_pretrained(
+        'model/best_model',
+        attn_implementation=attn_implementation,
+        use_safetensors=True,
+        low_cpu_mem_usage=True
+    )
+    # Move the model to the selected device (GPU or CPU).
+    torch_model.to(device)
+    # Set the model to evaluation mode (disables dropout, etc.).
+    torch_model.eval()
+    return torch_model
+
+# Applies inference-only optimizations to the PyTorch model. This runs only when we serve
+# straight from PyTorch; the ONNX export loads its own untouched FP32 copy.
+def prepare_torch_model(model):
+    # Dropout already does nothing in eval mode, but every nn.Dropout is still a module call
+    # on each forward pass. Swapping them for nn.Identity removes that overhead.
+    for module in model.modules():
+        for name, child in module.named_children():
+            if isinstance(child, torch.nn.Dropout):
+                setattr(module, name, torch.nn.Identity())
+
+    if device.type == 'cpu':
+        # Dynamic INT8 quantization: every nn.Linear (the bulk of BERT's compute) gets int8 weights
+        # and an int8 GEMM, while embeddings and LayerNorm stay in FP32. Much faster on CPU.
+        # inplace=True swaps the layers in the existing model rather than deep-copying it first,
+        # which would copy the memory-mapped FP32 weights into private memory.
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        print("Applied dynamic INT8 quantization to the model.")
+
+    # On a GPU, torch.compile can be used in place of TorchScript (see CompiledModelRunner).
+    # It's opt-in because compiling adds a lot to startup time.
+    if TORCH_COMPILE and device.type == 'cuda':
+        return model
+
+    # Compile the model to TorchScript so it no longer goes through Python for every op.
+    # BERT from transformers can't be run through torch.jit.script, so we trace it instead;
+    # the traced graph reads batch size and sequence length from its inputs, so it still
+    # handles any input shape. Freezing inlines the weights as constants, and
+    # optimize_for_inference then folds and fuses whatever it can.
+    example_inputs = tuple(t.to(device) for t in tokenize_text('warm up'))
+    try:
+        # Tracing runs under no_grad() rather than inference_mode(), since the traced graph
+        # can't hold on to inference-only tensors.
+        with torch.no_grad():
+            # strict=False lets the traced model keep returning a dict with 'logits' in it.
+            scripted = torch.jit.trace(model, example_inputs, strict=False)
+        scripted = torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+        # The first couple of calls are where TorchScript profiles and optimizes the graph,
+        # so get those out of the way now rather than on a real request.
+        with torch.inference_mode():
+            for _ in range(2):
+                scripted(*example_inputs)
+        model = scripted
+        print("Compiled the model to TorchScript.")
+    except Exception as e:
+        print(f"Could not compile the model to TorchScript, running it eagerly: {str(e)}")
+    return model
+
+# Checks whether a cached artifact (ONNX graph, TensorRT engine) exists and is newer than the weights.
+def is_up_to_date(path):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(MODEL_WEIGHTS_PATH)
+
+# Exports the fine-tuned model to ONNX, unless we already have an up-to-date export on disk.
+def export_onnx_model():
+    if is_up_to_date(ONNX_MODEL_PATH):
+        return
+
+    print("Exporting model to ONNX (this only happens once)...")
+    # Export the plain 'eager' attention graph, since that's the pattern ONNX Runtime and
+    # TensorRT know how to fuse into their own attention kernels. The export always runs on
+    # the CPU; the resulting graph is the same either way, and this keeps CUDA out of the
+    # Gunicorn master process (CUDA doesn't survive fork()).
+    export_model = BertForSequenceClassification.from_pretrained(
+        'model/best_model', attn_implementation='eager', use_safetensors=True, low_cpu_mem_usage=True
+    ).eval()
+    dummy_inputs = tokenize_text('export')
+    # Write to a temporary file and move it into place once it's complete, so another process
+    # can never load a half-written export.
+    tmp_path = f"{ONNX_MODEL_PATH}.{os.getpid()}.tmp"
+    torch.onnx.export(
+        export_model,
+        dummy_inputs,
+        tmp_path,
+        opset_version=17,
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['logits'],
+        # Batch size and sequence length can both vary between calls.
+        dynamic_axes={
+            'input_ids': {0: 'batch', 1: 'sequence'},
+            'attention_mask': {0: 'batch', 1: 'sequence'},
+            'logits': {0: 'batch'}
+        },
+        # Use the TorchScript-based exporter, which is what opset_version and dynamic_axes above
+        # are written for. Newer torch versions default to the dynamo exporter, which needs extra
+        # packages (onnx, onnxscript) and handles dynamic shapes differently.
+        dynamo=False
+    )
+    os.replace(tmp_path, ONNX_MODEL_PATH)
+
+# Builds an ONNX Runtime session with all graph optimizations turned on.
+# ORT fuses LayerNorm/GELU/Attention into single kernels, which is where most of the speedup comes from.
+def load_ort_session(intra_op_threads=None):
+    export_onnx_model()
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads:
+        sess_options.intra_op_num_threads = intra_op_threads
+    # Prefer the GPU when ORT was built with CUDA support, otherwise use the CPU.
+    providers = [p for p in ['CUDAExecutionProvider', 'CPUExecutionProvider'] if p in ort.get_available_providers()]
+    return ort.InferenceSession(ONNX_MODEL_PATH, sess_options, providers=providers)
+
+# Compiles the ONNX graph into an FP16 TensorRT engine with trtexec, unless one is already cached.
+def build_trt_engine():
+    if is_up_to_date(TRT_ENGINE_PATH):
+        return
+    if shutil.which('trtexec') is None:
+        raise RuntimeError(f"'{TRT_ENGINE_PATH}' not found and trtexec isn't on the PATH to build it.")
+
+    export_onnx_model()
+    print("Building TensorRT engine (this can take a few minutes)...")
+    max_length = config['max_length']
+
+    def shapes(batch, length):
+        return f"input_ids:{batch}x{length},attention_mask:{batch}x{length}"
+
+    # Same as the ONNX export: build into a temporary file and move it into place when done.
+    tmp_path = f"{TRT_ENGINE_PATH}.{os.getpid()}.tmp"
+    subprocess.run([
+        'trtexec',
+        f'--onnx={ONNX_MODEL_PATH}',
+        '--fp16',
+        f'--saveEngine={tmp_path}',
+        f'--minShapes={shapes(1, 1)}',
+        f'--optShapes={shapes(8, max_length)}',
+        f'--maxShapes={shapes(TRT_MAX_BATCH, max_length)}'
+    ], check=True, stdout=subprocess.DEVNULL)
+    os.replace(tmp_path, TRT_ENGINE_PATH)
+
+# Runs one forward pass on whichever backend is active and returns the raw logits as a NumPy array.
+def run_inference(input_ids, attention_mask):
+    if trt_runner is not None:
+        return trt_runner(input_ids, attention_mask)
+
+    if ort_session is not None:
+        return ort_session.run(['logits'], {
+            'input_ids': input_ids.numpy(),
+            'attention_mask': attention_mask.numpy()
+        })[0]
+
+    if compiled_runner is not None:
+        return compiled_runner(input_ids.to(device), attention_mask.to(device))
+
+    # Single texts on the GPU can replay the captured CUDA graph instead.
+    if cuda_graph_runner is not None and input_ids.shape[0] == 1:
+        return cuda_graph_runner(input_ids.to(device), attention_mask.to(device))
+
+    # We use torch.inference_mode() to tell PyTorch we're not training. It's a stricter (and
+    # slightly cheaper) version of torch.no_grad() that also skips autograd's bookkeeping.
+    with torch.inference_mode():
+        outputs = model(input_ids.to(device), attention_mask.to(device))
+    return outputs['logits'].cpu().numpy()
+
 # Prepares a given text string so it's in the right format for the BERT model.
+# The same text often comes in more than once (e.g. someone hitting "try again"), so we keep
+# the most recent results around and skip the tokenizer entirely for repeats. Only short
+# texts are cached, so a handful of huge request bodies can't pin memory in the cache.
+# Returns an (input_ids, attention_mask) tuple. Since these tensors are shared between
+# requests, callers must treat them as read-only.
 def preprocess_text(text):
+    if len(text) <= CACHE_MAX_TEXT_LENGTH:
+        return cached_tokenize_text(text)
+    return tokenize_text(text)
+
+# Tokenizes a single text for BERT. Request threads call this concurrently on the one shared
+# tokenizer, which is only safe as long as its padding/truncation settings never change, since
+# changing them mutates the tokenizer. So every tokenizer call in this file goes through here,
+# warm-ups and the ONNX export included.
+def tokenize_text(text):
     # This is the standard way to tokenize text for BERT.
-    return tokenizer(
+    encoding = tokenizer(
         text,
         add_special_tokens=True,
         max_length=config['max_length'], # Make sure it fits the model's expected input size.
-        padding='max_length',
+        # A single text never needs padding. Attention cost grows with the square of the
+        # sequence length, so padding "hello" out to 128 tokens would just waste compute.
+        padding=False,
         truncation=True,
         return_tensors='pt' # Return PyTorch tensors.
     )
+    return encoding['input_ids'], encoding['attention_mask']
+
+cached_tokenize_text = functools.lru_cache(maxsize=4096)(tokenize_text)
+
+
+# --- Request Batching ---
+
+# Runs forever in a background thread, pulling requests off the queue and running them in batches.
+def batch_worker():
+    # The compiled model has to be warmed up on the thread that will be running it.
+    if compiled_runner is not None:
+        try:
+            compiled_runner.warm_up()
+            print("Compiled the model with torch.compile.")
+        except Exception as e:
+            # Keep serving; each request will then compile (or fail) on its own.
+            print(f"Could not warm up the compiled model: {str(e)}")
+    # The TensorRT engine can't take batches bigger than it was built for.
+    max_batch = min(BATCH_MAX, TRT_MAX_BATCH) if trt_runner is not None else BATCH_MAX
+    while True:
+        # Block until at least one request shows up, then collect more until the batch is full or time runs out.
+        batch = [request_queue.get()]
+        deadline = time.monotonic() + BATCH_TIMEOUT_MS / 1000
+        while len(batch) < max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(request_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            # Each request arrives already tokenized, so we only need to stack them into one
+            # batch, padding up to the longest text in it rather than all the way to max_length.
+            input_ids = torch.nn.utils.rnn.pad_sequence(
+                [ids[0] for ids, _, _, _ in batch], batch_first=True, padding_value=tokenizer.pad_token_id
+            )
+            attention_mask = torch.nn.utils.rnn.pad_sequence(
+                [mask[0] for _, mask, _, _ in batch], batch_first=True, padding_value=0
+            )
+            logits = run_inference(input_ids, attention_mask)
+            # Hand each request back its own row of the output.
+            for (_, _, _, result), row in zip(batch, logits):
+                result['logits'] = row
+        except Exception as e:
+            # If the batch fails, every request in it fails with the same error.
+            for _, _, _, result in batch:
+                result['error'] = e
+        finally:
+            for _, _, done, _ in batch:
+                done.set()
+
+# Starts the batching thread. It's a daemon thread, so it won't keep the process alive on shutdown.
+# The compiled model can only be run from one thread, so it always goes through here, even with
+# BATCH_MAX set to 1 (in which case the "batches" are just single requests).
+def start_batch_worker():
+    global batching_enabled
+    if BATCH_MAX > 1 or compiled_runner is not None:
+        batching_enabled = True
+        threading.Thread(target=batch_worker, name='batch-worker', daemon=True).start()
+        if BATCH_MAX > 1:
+            print(f"Request batching enabled (up to {BATCH_MAX} texts, {BATCH_TIMEOUT_MS:g}ms window).")
+
+# Queues a tokenized text for the batching thread and waits for its logits to come back.
+def run_batched_inference(input_ids, attention_mask):
+    done = threading.Event()
+    result = {}
+    request_queue.put((input_ids, attention_mask, done, result))
+    done.wait()
+    if 'error' in result:
+        raise result['error']
+    return result['logits']
 
 
 # --- API Endpoints ---
@@ -86,7 +619,7 @@ def health_check():
 def analyze_sentiment():
     try:
         # First, a sanity check to make sure our model is actually loaded.
-        if model is None:
+        if backend is None:
             print("ERROR: /analyze called but model is not loaded.")
             return jsonify({'error': 'Model not loaded, please check server logs.'}), 500
 
@@ -100,20 +633,20 @@ def analyze_sentiment():
         english_text = text 
 
         # Step 2: Preprocess the text and run it through the model.
-        encoding = preprocess_text(english_text)
-        input_ids = encoding['input_ids'].to(device)
-        attention_mask = encoding['attention_mask'].to(device)
-
-        # We use torch.no_grad() to tell PyTorch we're not training, which saves memory and speeds things up.
-        with torch.no_grad():
-            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
-            # Apply softmax to get probabilities.
-            predictions = torch.nn.functional.softmax(outputs.logits, dim=1)
+        # With batching on, the background worker runs it alongside any other pending requests.
+        input_ids, attention_mask = preprocess_text(english_text)
+        if batching_enabled:
+            logits = run_batched_inference(input_ids, attention_mask)
+        else:
+            logits = run_inference(input_ids, attention_mask)[0]
 
         # Step 3: Extract the results.
-        confidence, predicted_idx = torch.max(predictions, dim=1)
-        predicted_emotion = label_encoder_classes[predicted_idx.item()]
-        confidence = confidence.item()
+        # We only need the top emotion and its probability, so we pick it straight from the raw
+        # logits and skip building the full probability vector. Since it's the largest logit,
+        # its softmax probability is simply 1 / sum(exp(logits - top_logit)), which can't overflow.
+        predicted_idx = int(logits.argmax())
+        predicted_emotion = label_encoder_classes[predicted_idx]
+        confidence = float(1.0 / np.exp(logits - logits[predicted_idx]).sum())
         
         # Get the confidence threshold from environment variables, defaulting to 0.75
         # This allows us to tune the sensitivity without changing the code.
@@ -140,12 +673,19 @@ def analyze_sentiment():
 
 # --- Main Execution Block ---
 
+# Note: when running under Gunicorn this block doesn't run at all; the hooks in
+# gunicorn.conf.py take care of loading the model in each worker instead.
 if __name__ == '__main__':
     # We must load the model *before* we start the server.
     if load_model_and_config():
+        start_batch_worker()
         # Get the port from environment variables, with a default of 5001.
         port = int(os.getenv('SENTIMENT_SERVICE_PORT', 5001))
-        print(f"🚀 Starting server on port {port}...")
-        app.run(host='0.0.0.0', port=port, debug=True)
+        print(f"🚀 Starting development server on port {port}...")
+        # This is Flask's built-in server, which is only meant for local development (and is
+        # what start.ps1 uses on Windows). In production, run it under Gunicorn instead:
+        #   gunicorn app:app
+        # which picks up its settings from gunicorn.conf.py.
+        app.run(host='0.0.0.0', port=port, threaded=True)
     else:
         print("❌ Model loading failed. Shutting down.")
@@ -1,10 +1,10 @@
 # nltk_downloader.py
 # This is a simple, one-off utility script.
 # Its only job is to download the necessary data packages that the NLTK
-# (Natural Language Toolkit) library needs to perform tasks like tokenization,
-# lemmatization, and part-of-speech tagging.
+# (Natural Language Toolkit) library needs for lemmatization.
 
-# You should run this script once before starting the main application for the first time.
+# NLTK is only used for training (train_model.py); the sentiment service itself doesn't need it.
+# You should run this script once before training the model for the first time.
 
 import nltk
 
@@ -14,9 +14,7 @@ def download_nltk_data():
     """
     # List of packages we need for our NLP tasks.
     required_packages = [
-        'punkt',                  # Used for tokenizing text (splitting into sentences/words)
-        'wordnet',                # A large lexical database of English.
-        'averaged_perceptron_tagger', # Used for Part-of-Speech (POS) tagging.
+        'wordnet',                # A large lexical database of English, used by the lemmatizer.
         'omw-1.4'                 # Open Multilingual Wordnet, for wordnet to work in multiple languages.
     ]
 
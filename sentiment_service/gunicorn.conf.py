@@ -0,0 +1,60 @@
+# gunicorn.conf.py
+# Production server settings for the sentiment service.
+# Gunicorn reads this file automatically, so from the 'sentiment_service/' directory just run:
+#   gunicorn app:app
+#
+# Any setting here can still be overridden on the command line or via GUNICORN_CMD_ARGS.
+
+import multiprocessing
+import os
+import sys
+from dotenv import load_dotenv
+from gunicorn.arbiter import Arbiter
+
+# Load environment variables from a .env file if it exists.
+load_dotenv()
+
+# Ask PyTorch to check for a GPU through NVML instead of initializing CUDA. A CUDA context
+# created in the master process would break every worker forked from it.
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+import torch
+
+USE_GPU = torch.cuda.is_available()
+
+# --- Server Settings ---
+bind = f"0.0.0.0:{os.getenv('SENTIMENT_SERVICE_PORT', 5001)}"
+# 'gthread' workers serve several requests at once on a pool of threads, which is what
+# lets the batching thread in app.py group concurrent requests together.
+worker_class = 'gthread'
+# On CPU, one worker per core, with the cores split between them (see post_fork). Each worker
+# holds its own copy of the model (~440 MB), so lower GUNICORN_WORKERS if RAM is tight.
+# On a GPU every worker would need its own copy of the model in GPU memory, so use a single
+# worker with more threads and let batching do the work.
+workers = int(os.getenv('GUNICORN_WORKERS', 1 if USE_GPU else multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', 8 if USE_GPU else 4))
+# Import app.py (and with it torch/transformers) once in the master, so the workers share those pages.
+preload_app = True
+# Workers load the model while booting, which can take longer than Gunicorn's default 30s.
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+
+
+# --- Server Hooks ---
+
+# Runs once in the master, after app.py is imported and before any workers are started.
+def when_ready(server):
+    import app
+    app.prepare_model_artifacts()
+
+# Runs in each worker right after it's forked from the master.
+# ONNX Runtime sessions, CUDA contexts and background threads don't survive fork(), so every
+# worker loads its own model and starts its own batching thread.
+def post_fork(server, worker):
+    import app
+    # ONNX Runtime and PyTorch would otherwise each use every core for a single forward pass,
+    # in every worker at once. Split the cores between the workers instead (or set INTRA_OP_THREADS).
+    intra_op_threads = int(os.getenv('INTRA_OP_THREADS', max(1, multiprocessing.cpu_count() // server.cfg.workers)))
+    if not app.load_model_and_config(intra_op_threads=intra_op_threads):
+        print("❌ Model loading failed. Shutting down.")
+        # This exit code tells Gunicorn to stop instead of endlessly restarting the worker.
+        sys.exit(Arbiter.WORKER_BOOT_ERROR)
+    app.start_batch_worker()
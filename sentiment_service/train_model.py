@@ -17,34 +17,30 @@ import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import Dataset, DataLoader
-from transformers import BertTokenizer, BertForSequenceClassification
+from transformers import BertTokenizerFast, BertForSequenceClassification
 from torch.optim import AdamW
 from transformers import get_scheduler
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
+import functools
 import json
 import os
 import re
 import sys
+from multiprocessing import Pool
 
 # --- NLTK Imports & Setup ---
 # We're using the Natural Language Toolkit for text preprocessing.
 import nltk
 from nltk.stem import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
-
-# Let's make sure the necessary NLTK data is present before we start.
-# This script assumes you've already run nltk_downloader.py.
-try:
-    nltk.data.find('tokenizers/punkt')
-    nltk.data.find('corpora/wordnet')
-except nltk.downloader.DownloadError:
-    print("❌ NLTK data not found. Please run the 'nltk_downloader.py' script first.")
-    exit()
 
 # Initialize the lemmatizer once, so we don't have to do it repeatedly.
 lemmatizer = WordNetLemmatizer()
 
+# Matches everything that isn't a lowercase letter or whitespace.
+# Compiled once here instead of on every call.
+NON_ALPHA_PATTERN = re.compile(r'[^a-z\s]')
+
 
 # --- Configuration ---
 # It's good practice to have key parameters in one place for easy tweaking.
@@ -52,105 +48,171 @@ MODEL_NAME = 'bert-base-uncased'
 MAX_LENGTH = 128
 BATCH_SIZE = 16
 NUM_EPOCHS = 10
+# How many of BERT's 12 encoder layers stay frozen during fine-tuning.
+NUM_FROZEN_LAYERS = 10
 OUTPUT_DIR = 'model'
+# Seed for the random choices made during data augmentation, so runs are reproducible.
+AUGMENTATION_SEED = 42
+# Background processes that prepare batches for the DataLoader while the model trains.
+DATALOADER_WORKERS = min(8, os.cpu_count() or 1)
+# Set TORCH_COMPILE=true to train through torch.compile on a GPU. It's opt-in because it needs
+# Triton, which isn't available on Windows or older GPUs, and fails there on the first batch.
+TORCH_COMPILE = os.getenv('TORCH_COMPILE', 'false').lower() == 'true'
+# Lemmatization is spread across this many processes for big datasets.
+PREPROCESS_WORKERS = os.cpu_count() or 1
+# Below this many rows, starting the worker processes costs more than it saves.
+PARALLEL_PREPROCESS_MIN_ROWS = 5000
 
 
 # --- PyTorch Dataset Class ---
 # This class formats our data in a way that PyTorch's DataLoader can understand.
 class EmotionDataset(Dataset):
     def __init__(self, texts, labels, tokenizer, max_length=MAX_LENGTH):
-        self.texts = texts
-        self.labels = labels
-        self.tokenizer = tokenizer
-        self.max_length = max_length
-    
-    def __len__(self):
-        # The total number of samples in the dataset.
-        return len(self.texts)
-    
-    def __getitem__(self, idx):
-        # Fetches one sample of data.
-        text = str(self.texts[idx])
-        label = self.labels[idx]
-        
+        # Tokenization always gives the same result for the same text, so we do it once for
+        # the whole dataset up front instead of on every sample in every epoch.
         # The tokenizer converts our raw text into numbers (token IDs) that the model can process.
-        encoding = self.tokenizer(
-            text,
+        encoding = tokenizer(
+            [str(text) for text in texts],
             add_special_tokens=True,      # Adds [CLS] and [SEP] tokens
-            max_length=self.max_length,
+            max_length=max_length,
             padding='max_length',         # Pad shorter sentences to max_length
             truncation=True,              # Truncate longer sentences
             return_tensors='pt'           # Return PyTorch tensors
         )
-        
+        self.input_ids = encoding['input_ids']
+        self.attention_mask = encoding['attention_mask']
+        self.labels = torch.as_tensor(labels, dtype=torch.long)
+    
+    def __len__(self):
+        # The total number of samples in the dataset.
+        return len(self.labels)
+    
+    def __getitem__(self, idx):
+        # Fetches one sample of data; everything is already a tensor, so this is just indexing.
         return {
-            'input_ids': encoding['input_ids'].flatten(),
-            'attention_mask': encoding['attention_mask'].flatten(),
-            'label': torch.tensor(label, dtype=torch.long)
+            'input_ids': self.input_ids[idx],
+            'attention_mask': self.attention_mask[idx],
+            'label': self.labels[idx]
         }
 
 # --- Text Processing Functions ---
 
-def preprocess_text(text):
+def ensure_nltk_data():
+    """
+    Makes sure the necessary NLTK data is present before we start.
+    This script assumes you've already run download_nltk_data.py.
+    It's called when the script starts rather than on import, so importing this module
+    (e.g. from the preprocessing worker processes) never touches the NLTK data directory.
+    """
+    try:
+        nltk.data.find('corpora/wordnet')
+    except LookupError:
+        print("❌ NLTK data not found. Please run the 'download_nltk_data.py' script first.")
+        sys.exit(1)
+
+
+@functools.lru_cache(maxsize=None)
+def lemmatize_word(word):
     """
-    Cleans and preprocesses a single string of text.
+    Lemmatizes a single word (e.g., 'running' -> 'run', 'studies' -> 'study').
+    Results are cached, so each distinct word only hits WordNet once across the whole dataset.
+    """
+    return lemmatizer.lemmatize(word)
+
+
+def lemmatize_text(text):
+    """
+    Lemmatizes every word in an already-cleaned string and joins them back together.
+    """
+    return ' '.join(lemmatize_word(word) for word in text.split())
+
+
+def init_preprocess_worker():
+    """
+    Runs once in each preprocessing worker process. Sets up that worker's own lemmatizer and
+    forces WordNet to load now, rather than on the first word of the first chunk.
+    """
+    global lemmatizer
+    lemmatizer = WordNetLemmatizer()
+    lemmatizer.lemmatize('warmup')
+
+
+def preprocess_texts(texts):
+    """
+    Cleans and preprocesses a whole pandas Series of texts.
     - Converts to lowercase
     - Removes non-alphanumeric characters
     - Tokenizes and lemmatizes words
+    The lowercasing and character stripping run as vectorized string operations
+    instead of one Python call per row. Non-string values (e.g. NaN) become empty strings.
     """
-    if not isinstance(text, str):
-        return ""
-    
-    # 1. Convert to lowercase
-    text = text.lower()
-    
-    # 2. Remove non-alphanumeric characters but keep spaces
-    text = re.sub(r'[^a-z\s]', '', text)
-    
-    # 3. Tokenize (split text into a list of words)
-    tokens = word_tokenize(text)
-    
-    # 4. Lemmatize each word (e.g., 'running' -> 'run', 'studies' -> 'study')
-    # This helps the model by reducing vocabulary size.
-    lemmatized_tokens = [lemmatizer.lemmatize(word) for word in tokens]
-    
-    # 5. Join the words back into a single string
-    return ' '.join(lemmatized_tokens)
+    # 1. Convert to lowercase, then remove non-alphanumeric characters but keep spaces
+    cleaned = texts.where(texts.map(lambda text: isinstance(text, str)), '')
+    cleaned = cleaned.astype(str).str.lower().str.replace(NON_ALPHA_PATTERN, '', regex=True)
 
+    # 2. Tokenize and lemmatize each word. Once only letters and spaces are left,
+    # a plain split() is all the tokenizing we need.
+    # Lemmatizing is still one Python call per word, so for big datasets we split the
+    # rows across all CPU cores. Each row is independent, so this parallelizes cleanly.
+    if PREPROCESS_WORKERS > 1 and len(cleaned) >= PARALLEL_PREPROCESS_MIN_ROWS:
+        with Pool(PREPROCESS_WORKERS, initializer=init_preprocess_worker) as pool:
+            return pool.map(lemmatize_text, cleaned.tolist(), chunksize=512)
+    return cleaned.map(lemmatize_text).tolist()
 
-def augment_text(text):
+
+def augment_text(words, remove_idx, swaps):
     """
-    Performs simple text augmentation to create more training data.
+    Performs simple text augmentation on one (already split) text to create more training data.
     This helps the model become more robust to variations in text.
+    The random choices are made up front by augment_texts: `remove_idx` is the word to drop
+    and `swaps[i]` says whether to swap words i and i+1.
     TODO: Could add more sophisticated techniques like back-translation.
     """
     augmented = []
-    words = text.split()
-    
-    # Don't augment very short texts, it might remove all the meaning.
-    if len(words) <= 3:
-        return [text]
     
     # Always include the original text
-    augmented.append(text)
+    augmented.append(' '.join(words))
     
     # Technique 1: Randomly remove one word
     if len(words) > 4:
-        remove_idx = np.random.randint(0, len(words))
         aug_text = ' '.join(words[:remove_idx] + words[remove_idx+1:])
         augmented.append(aug_text)
     
     # Technique 2: Slightly shuffle word order (swap adjacent words)
     words_copy = words.copy()
-    for i in range(len(words_copy)-1):
-        if np.random.random() < 0.3:  # 30% chance to swap
-            words_copy[i], words_copy[i+1] = words_copy[i+1], words_copy[i]
+    for i in np.flatnonzero(swaps):  # each pair had a 30% chance to be picked
+        words_copy[i], words_copy[i+1] = words_copy[i+1], words_copy[i]
     aug_text = ' '.join(words_copy)
     augmented.append(aug_text)
     
     return augmented
 
 
+def augment_texts(texts, rng):
+    """
+    Augments a whole list of texts, returning a list of variants for each one.
+    All the random numbers for the whole dataset are drawn in two NumPy calls,
+    rather than one call per text and per word.
+    """
+    word_lists = [text.split() for text in texts]
+    lengths = np.array([len(words) for words in word_lists], dtype=np.int64)
+    
+    # One word to remove per text, and one swap decision per word (the last word's is unused).
+    remove_indices = rng.integers(0, np.maximum(lengths, 1))
+    swap_decisions = rng.random(lengths.sum()) < 0.3  # 30% chance to swap
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    
+    augmented = []
+    for i, (text, words) in enumerate(zip(texts, word_lists)):
+        # Don't augment very short texts, it might remove all the meaning.
+        if lengths[i] <= 3:
+            augmented.append([text])
+            continue
+        swaps = swap_decisions[offsets[i]:offsets[i] + lengths[i] - 1]
+        augmented.append(augment_text(words, remove_indices[i], swaps))
+    return augmented
+
+
 def load_and_preprocess_data(file_path):
     """
     Loads the dataset from a CSV, preprocesses, and augments it.
@@ -172,7 +234,7 @@ def load_and_preprocess_data(file_path):
     
     # Apply our NLTK preprocessing to the 'text' column.
     print("--- Preprocessing texts with NLTK... ---")
-    df['text'] = df['text'].apply(preprocess_text)
+    df['text'] = preprocess_texts(df['text'])
     df = df[df['text'].str.len() > 0]  # Remove any rows that became empty after cleaning.
     
     # Apply data augmentation
@@ -180,8 +242,8 @@ def load_and_preprocess_data(file_path):
     augmented_texts = []
     augmented_emotions = []
     
-    for text, emotion in zip(df['text'], df['emotion']):
-        aug_texts = augment_text(text)
+    rng = np.random.default_rng(AUGMENTATION_SEED)
+    for aug_texts, emotion in zip(augment_texts(df['text'].tolist(), rng), df['emotion']):
         augmented_texts.extend(aug_texts)
         augmented_emotions.extend([emotion] * len(aug_texts))
     
@@ -196,29 +258,46 @@ def load_and_preprocess_data(file_path):
 
 # --- Training & Evaluation Functions ---
 
-def train_epoch(model, data_loader, optimizer, scheduler, device):
+def detach_layer_output(module, inputs, output):
+    """
+    Forward hook that detaches a layer's hidden states from the autograd graph.
+    While everything before the layer is frozen this changes nothing, since autograd
+    already records nothing there; it's a guard that keeps the backward pass from
+    reaching into those layers if something upstream ever requires gradients again.
+    """
+    if isinstance(output, tuple):
+        return (output[0].detach(),) + output[1:]
+    return output.detach()
+
+
+def train_epoch(model, data_loader, optimizer, scheduler, device, scaler):
     """
     Performs one full pass over the training data.
+    On a GPU, the forward pass runs in mixed precision (FP16), with the GradScaler
+    scaling the loss so small FP16 gradients don't underflow to zero.
     """
     model.train() # Set the model to training mode
+    trainable_params = [p for p in model.parameters() if p.requires_grad]
     total_loss = 0
     correct_predictions = 0
     total_predictions = 0
     
     for batch in data_loader:
-        # Move batch data to the correct device (GPU or CPU)
-        input_ids = batch['input_ids'].to(device)
-        attention_mask = batch['attention_mask'].to(device)
-        labels = batch['label'].to(device)
+        # Move batch data to the correct device (GPU or CPU).
+        # The batches come from pinned memory, so these copies can overlap with the GPU's work.
+        input_ids = batch['input_ids'].to(device, non_blocking=True)
+        attention_mask = batch['attention_mask'].to(device, non_blocking=True)
+        labels = batch['label'].to(device, non_blocking=True)
         
         optimizer.zero_grad() # Clear previous gradients
         
         # Forward pass: compute predicted outputs by passing inputs to the model
-        outputs = model(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            labels=labels
-        )
+        with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+            outputs = model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                labels=labels
+            )
         
         loss = outputs.loss
         total_loss += loss.item()
@@ -229,13 +308,17 @@ def train_epoch(model, data_loader, optimizer, scheduler, device):
         total_predictions += labels.size(0)
         
         # Backward pass: compute gradient of the loss with respect to model parameters
-        loss.backward()
+        scaler.scale(loss).backward()
         
         # Clip gradients to prevent them from exploding
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        # (they have to be unscaled first, so the threshold applies to their real values)
+        scaler.unscale_(optimizer)
+        # (only the trainable parameters can have gradients, so there's no point walking the frozen ones)
+        torch.nn.utils.clip_grad_norm_(trainable_params, 1.0)
         
         # Perform a single optimization step (parameter update)
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
         scheduler.step()
     
     avg_loss = total_loss / len(data_loader)
@@ -255,15 +338,17 @@ def evaluate(model, data_loader, device):
     # We don't need to calculate gradients during evaluation.
     with torch.no_grad():
         for batch in data_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            labels = batch['label'].to(device)
+            input_ids = batch['input_ids'].to(device, non_blocking=True)
+            attention_mask = batch['attention_mask'].to(device, non_blocking=True)
+            labels = batch['label'].to(device, non_blocking=True)
             
-            outputs = model(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                labels=labels
-            )
+            # Same mixed precision as in training; there's no backward pass, so no scaler needed.
+            with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+                outputs = model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    labels=labels
+                )
             
             loss = outputs.loss
             total_loss += loss.item()
@@ -305,7 +390,7 @@ def train_sentiment_model(dataset_path):
         
         # 3. Load BERT tokenizer and model
         print(f"\n--- Loading BERT model ({MODEL_NAME}) and tokenizer... ---")
-        tokenizer = BertTokenizer.from_pretrained(MODEL_NAME)
+        tokenizer = BertTokenizerFast.from_pretrained(MODEL_NAME)
         model = BertForSequenceClassification.from_pretrained(
             MODEL_NAME,
             num_labels=num_labels,
@@ -318,11 +403,24 @@ def train_sentiment_model(dataset_path):
             param.requires_grad = False
         
         for i, layer in enumerate(model.bert.encoder.layer):
-            if i < 10:  # Freeze the first 10 out of 12 layers
+            if i < NUM_FROZEN_LAYERS:  # Freeze the first NUM_FROZEN_LAYERS out of 12 layers
                 for param in layer.parameters():
                     param.requires_grad = False
         
+        # Cut the autograd graph right after the last frozen layer. With the embeddings and these
+        # layers frozen, autograd already skips them, so this is only a guard in case that changes.
+        if NUM_FROZEN_LAYERS > 0:
+            model.bert.encoder.layer[NUM_FROZEN_LAYERS - 1].register_forward_hook(detach_layer_output)
+        
         model.to(device)
+        
+        # With TORCH_COMPILE on a GPU, compile the model into fused kernels (replayed as CUDA graphs
+        # in 'reduce-overhead' mode). Every batch is padded to MAX_LENGTH, so apart from a smaller
+        # final batch the input shape never changes and dynamic shapes can be turned off.
+        # We keep `model` itself around for saving checkpoints.
+        training_model = model
+        if TORCH_COMPILE and device.type == 'cuda':
+            training_model = torch.compile(model, mode='reduce-overhead', dynamic=False)
         print("✅ BERT model loaded successfully!")
         
         # 5. Split data into training and validation sets
@@ -339,19 +437,31 @@ def train_sentiment_model(dataset_path):
         train_dataset = EmotionDataset(train_texts, train_labels, tokenizer)
         val_dataset = EmotionDataset(val_texts, val_labels, tokenizer)
         
-        train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
-        val_loader = DataLoader(val_dataset, batch_size=BATCH_SIZE)
+        # Batches are assembled by background workers (kept alive between epochs) and, on a GPU,
+        # placed in pinned memory so they can be copied over without blocking.
+        loader_options = {
+            'batch_size': BATCH_SIZE,
+            'num_workers': DATALOADER_WORKERS,
+            'pin_memory': device.type == 'cuda',
+            'persistent_workers': True,
+            'prefetch_factor': 4
+        }
+        train_loader = DataLoader(train_dataset, shuffle=True, **loader_options)
+        val_loader = DataLoader(val_dataset, **loader_options)
         print("✅ Datasets prepared successfully!")
         
         # 7. Setup optimizer and learning rate scheduler
         warmup_steps = len(train_loader) * 2  # 2 epochs of warmup
         total_steps = len(train_loader) * NUM_EPOCHS
         
-        # Use different learning rates for different parts of the model
+        # Use different learning rates for different parts of the model. The top encoder layer
+        # gets 1e-4, and each trainable layer below it half the rate of the one above.
+        num_layers = len(model.bert.encoder.layer)
         optimizer_grouped_parameters = [
             {'params': [p for n, p in model.named_parameters() if 'classifier' in n], 'lr': 2e-4, 'weight_decay': 0.01},
-            {'params': [p for n, p in model.named_parameters() if 'layer.11' in n], 'lr': 1e-4, 'weight_decay': 0.01},
-            {'params': [p for n, p in model.named_parameters() if 'layer.10' in n], 'lr': 5e-5, 'weight_decay': 0.01},
+        ] + [
+            {'params': list(model.bert.encoder.layer[i].parameters()), 'lr': 1e-4 / 2 ** (num_layers - 1 - i), 'weight_decay': 0.01}
+            for i in range(num_layers - 1, NUM_FROZEN_LAYERS - 1, -1)
         ]
         
         optimizer = AdamW(optimizer_grouped_parameters)
@@ -362,6 +472,9 @@ def train_sentiment_model(dataset_path):
             num_training_steps=total_steps
         )
         
+        # Scales the loss for mixed-precision training on a GPU. On a CPU it's disabled and does nothing.
+        scaler = torch.amp.GradScaler('cuda', enabled=device.type == 'cuda')
+        
         best_accuracy = 0
         
         # 8. The main training loop
@@ -369,10 +482,10 @@ def train_sentiment_model(dataset_path):
         for epoch in range(NUM_EPOCHS):
             print(f"\nEpoch {epoch + 1}/{NUM_EPOCHS}")
             
-            train_loss, train_acc = train_epoch(model, train_loader, optimizer, scheduler, device)
+            train_loss, train_acc = train_epoch(training_model, train_loader, optimizer, scheduler, device, scaler)
             print(f"  Training   -> Loss: {train_loss:.4f}, Accuracy: {train_acc:.4f}")
             
-            val_loss, val_acc = evaluate(model, val_loader, device)
+            val_loss, val_acc = evaluate(training_model, val_loader, device)
             print(f"  Validation -> Loss: {val_loss:.4f}, Accuracy: {val_acc:.4f}")
             
             # Save the model only if it has the best validation accuracy so far
@@ -410,6 +523,8 @@ if __name__ == "__main__":
     
     dataset_file_path = sys.argv[1]
     
+    ensure_nltk_data()
+    
     try:
         train_sentiment_model(dataset_file_path)
     except Exception as e:
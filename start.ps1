@@ -1,3 +1,11 @@
+# --- Model Preparation ---
+# Exporting the model to ONNX can take well over a minute, so do it here (it's skipped when
+# the cached export is already up to date) instead of inside the health-check window below.
+Write-Host "Preparing sentiment model files..." -ForegroundColor Yellow
+Push-Location "$PSScriptRoot\sentiment_service"
+python -c "import app; app.prepare_model_artifacts()"
+Pop-Location
+
 Write-Host "🚀 Starting MindfulChat Sentiment Service..." -ForegroundColor Green
 $sentimentJob = Start-Job -ScriptBlock {
     # Ensure we are in the right directory inside the job